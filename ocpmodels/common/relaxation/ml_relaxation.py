@@ -55,6 +55,9 @@ def ml_relax(
         traj_dir=Path(traj_dir) if traj_dir is not None else None,
         traj_names=ids,
         early_stop_batch=early_stop_batch,
+        release_cache=relax_opt.get("release_cache", False),
+        log_every=relax_opt.get("log_every", 1),
+        scale_H0=relax_opt.get("scale_H0", False),
     )
     relaxed_batch = optimizer.run(fmax=fmax, steps=steps)
 
@@ -6,7 +6,8 @@ LICENSE file in the root directory of this source tree.
 """
 
 import logging
-from collections import deque
+import queue
+import threading
 from pathlib import Path
 
 import ase
@@ -18,6 +19,118 @@ from ocpmodels.common.relaxation.ase_utils import batch_to_atoms
 from ocpmodels.common.utils import radius_graph_pbc
 
 
+if hasattr(torch, "linalg") and hasattr(torch.linalg, "solve_triangular"):
+
+    @torch.jit.script
+    def _solve_triangular(
+        A: torch.Tensor, b: torch.Tensor, upper: bool
+    ) -> torch.Tensor:
+        return torch.linalg.solve_triangular(A, b, upper=upper)
+
+else:
+    # torch.triangular_solve is deprecated in favour of the above, which only
+    # exists from torch 1.11 on.
+    @torch.jit.script
+    def _solve_triangular(
+        A: torch.Tensor, b: torch.Tensor, upper: bool
+    ) -> torch.Tensor:
+        return torch.triangular_solve(b, A, upper=upper)[0]
+
+
+@torch.jit.script
+def _two_loop_recursion(
+    q: torch.Tensor,
+    z: torch.Tensor,
+    s: torch.Tensor,
+    y: torch.Tensor,
+    sy: torch.Tensor,
+    start: int,
+    count: int,
+    H0: torch.Tensor,
+) -> torch.Tensor:
+    # L-BFGS two-loop recursion, writing H @ q into z (q is overwritten, both
+    # are preallocated work buffers) and returning z. The history lives in
+    # (memory, n) ring buffers whose first `count` rows are filled, with the
+    # oldest entry at row `start`, and sy[i, j] = s[i] . y[j]; in particular
+    # rho = 1 / (s . y) is the reciprocal of its diagonal.
+    #
+    # Both loops only depend on earlier iterations through dot products
+    # with s and y, which sy already holds. Each loop therefore reduces to
+    # one matrix-vector product over the history, a small triangular solve
+    # for the alpha (resp. beta) coefficients and one more matrix-vector
+    # product to apply them, instead of a dot and an axpy per entry.
+    #
+    # s, y and q stay in the working precision of the positions; only the
+    # (count, count) triangular systems are solved in the precision of sy.
+    if count == 0:
+        return z.copy_(q).mul_(H0)
+    s, y = s[:count], y[:count]
+    order = (torch.arange(count, device=q.device) + start) % count
+    sy = sy[:count, :count][order][:, order]
+    rho = sy.diagonal().reciprocal()
+    eye = torch.eye(count, dtype=sy.dtype, device=sy.device)
+
+    # First loop, newest to oldest:
+    #   alpha_i = rho_i * s_i . (q - sum_{j > i} alpha_j y_j)
+    sq = torch.mv(s, q)[order].to(sy.dtype)
+    upper = eye + rho.unsqueeze(1) * torch.triu(sy, 1)
+    alpha = _solve_triangular(upper, (rho * sq).unsqueeze(1), True)
+    alpha = alpha.squeeze(1)
+    coeff = torch.empty_like(alpha)
+    coeff[order] = alpha
+    q.addmv_(y.t(), coeff.to(q.dtype), alpha=-1.0)
+    z.copy_(q).mul_(H0)
+
+    # Second loop, oldest to newest:
+    #   beta_i = rho_i * y_i . (z + sum_{j < i} (alpha_j - beta_j) s_j)
+    yz = torch.mv(y, z)[order].to(sy.dtype)
+    ys = torch.tril(sy.t(), -1)
+    lower = eye + rho.unsqueeze(1) * ys
+    beta = _solve_triangular(
+        lower, (rho * (yz + torch.mv(ys, alpha))).unsqueeze(1), False
+    )
+    beta = beta.squeeze(1)
+    coeff[order] = alpha - beta
+    return z.addmv_(s.t(), coeff.to(q.dtype))
+
+
+@torch.jit.script
+def _clip_step(
+    dr: torch.Tensor,
+    longest_steps: torch.Tensor,
+    maxstep: float,
+    damping: float,
+) -> torch.Tensor:
+    # Rescale each atom's step so that the longest step of its system is at
+    # most maxstep, then damp it. Scripted so the elementwise tail runs as a
+    # fused kernel, with maxstep as a scalar rather than a new device tensor.
+    scale = (longest_steps + 1e-7).reciprocal() * torch.clamp(
+        longest_steps, max=maxstep
+    )
+    return dr * scale.unsqueeze(1) * damping
+
+
+def _write_frames(frames, trajectories, errors):
+    # Writes the (atoms_objects, active) items queued by LBFGS.run until a
+    # None sentinel arrives. After a failure it keeps draining the queue so
+    # the producer never blocks; run() re-raises the error once joined.
+    while True:
+        item = frames.get()
+        if item is None:
+            return
+        if errors:
+            continue
+        atoms_objects, active = item
+        try:
+            for atm, traj, is_active in zip(
+                atoms_objects, trajectories, active
+            ):
+                if is_active:
+                    traj.write(atm)
+        except Exception as e:
+            errors.append(e)
+
+
 class LBFGS:
     def __init__(
         self,
@@ -32,6 +145,9 @@ class LBFGS:
         traj_dir: Path = None,
         traj_names=None,
         early_stop_batch: bool = False,
+        release_cache: bool = False,
+        log_every: int = 1,
+        scale_H0: bool = False,
     ):
         self.atoms = atoms
         self.model = model
@@ -44,11 +160,26 @@ class LBFGS:
         self.traj_dir = traj_dir
         self.traj_names = traj_names
         self.early_stop_batch = early_stop_batch
+        self.release_cache = release_cache
+        self.log_every = log_every
+        self.scale_H0 = scale_H0
         assert not self.traj_dir or (
             traj_dir and len(traj_names)
         ), "Trajectory names should be specified to save trajectories"
         logging.info("Step   Fmax(eV/A)")
 
+        # The batch layout does not change during a relaxation, so derive
+        # everything that depends on it once. Passing dim_size to scatter
+        # also avoids a host sync on batch.max() in every reduction.
+        self._batch_indices = self.atoms.batch.to(self.device)
+        self._n_systems = self.atoms.natoms.numel()
+        self._first_atom = (
+            self.atoms.natoms.cumsum(0) - self.atoms.natoms
+        ).to(self.device)
+        self._zero = torch.zeros(
+            (), dtype=self.atoms.pos.dtype, device=self.device
+        )
+
         self.model.update_graph(self.atoms)
 
     def get_forces(self, apply_constraint=True):
@@ -59,119 +190,169 @@ class LBFGS:
         return self.atoms.pos
 
     def set_positions(self, update, update_mask):
-        r = self.get_positions()
+        # Start every step from a leaf so the autograd graph the force model
+        # builds on the positions does not chain across iterations.
+        r = self.get_positions().detach()
         if not self.early_stop_batch:
-            update = torch.where(update_mask.unsqueeze(1), update, 0.0)
-        self.atoms.pos = r + update.to(dtype=torch.float32)
+            update = torch.where(update_mask.unsqueeze(1), update, self._zero)
+        # The step is already computed in the dtype of the positions.
+        self.atoms.pos = r + update
         self.model.update_graph(self.atoms)
 
     def check_convergence(
-        self, iteration, update_mask, forces, force_threshold
+        self, iteration, update_mask, forces, force_threshold, steps
     ):
         if forces is None:
-            return False
+            return update_mask, False
         max_forces_ = scatter(
-            (forces ** 2).sum(axis=1).sqrt(), self.atoms.batch, reduce="max"
+            (forces ** 2).sum(axis=1).sqrt(),
+            self._batch_indices,
+            dim=0,
+            dim_size=self._n_systems,
+            reduce="max",
         )
-        max_forces = max_forces_[self.atoms.batch]
+        max_forces = max_forces_.index_select(0, self._batch_indices)
         update_mask = torch.logical_and(
             update_mask, max_forces.ge(force_threshold)
         )
-        logging.info(
-            f"{iteration} "
-            + " ".join(f"{x:0.3f}" for x in max_forces_.tolist())
-        )
-        return update_mask
+        converged = bool(torch.all(torch.logical_not(update_mask)))
+        # Printing the max forces copies them to the host, so only do it
+        # every `log_every` iterations and on the last one.
+        if self.log_every > 0 and (
+            iteration % self.log_every == 0 or iteration == steps or converged
+        ):
+            logging.info(
+                f"{iteration} "
+                + " ".join(f"{x:0.3f}" for x in max_forces_.tolist())
+            )
+        return update_mask, converged
 
     def run(self, fmax, steps):
-        s = deque(maxlen=self.memory)
-        y = deque(maxlen=self.memory)
-        rho = deque(maxlen=self.memory)
+        # Preallocated ring buffers holding the last `memory` steps. s and y
+        # share the dtype of the positions; their (small) matrix of dot
+        # products is kept in float64 for the triangular solves.
+        memory = min(self.memory, steps)
+        s = torch.zeros(
+            (memory, self.atoms.pos.numel()),
+            dtype=self.atoms.pos.dtype,
+            device=self.device,
+        )
+        y = torch.zeros_like(s)
+        sy = torch.zeros(
+            (memory, memory), dtype=torch.float64, device=self.device
+        )
+        # Work vectors for the recursion, reused on every step.
+        q = s.new_empty(self.atoms.pos.numel())
+        z = torch.empty_like(q)
         r0 = f0 = e0 = None
-        H0 = 1.0 / self.alpha
-        update_mask = torch.ones_like(self.atoms.batch).bool().to(self.device)
+        H0 = torch.tensor(1.0 / self.alpha, device=self.device)
+        update_mask = torch.ones_like(self._batch_indices, dtype=torch.bool)
 
-        trajectories = None
+        trajectories = writer = None
+        write_errors = []
         if self.traj_dir:
             self.traj_dir.mkdir(exist_ok=True, parents=True)
             trajectories = [
                 ase.io.Trajectory(self.traj_dir / f"{name}.traj", mode="a")
                 for name in self.traj_names
             ]
-
-        iteration = 0
-        converged = False
-        while iteration < steps and not converged:
-            r0, f0, e0 = self.step(
-                iteration, r0, f0, H0, rho, s, y, update_mask
-            )
-            iteration += 1
-            if trajectories is not None:
-                self.atoms.y, self.atoms.force = e0, f0
-                atoms_objects = batch_to_atoms(self.atoms)
-                update_mask_ = torch.split(
-                    update_mask, self.atoms.natoms.tolist()
-                )
-                for atm, traj, mask in zip(
-                    atoms_objects, trajectories, update_mask_
-                ):
-                    if mask[0]:
-                        traj.write(atm)
-            update_mask = self.check_convergence(
-                iteration, update_mask, f0, fmax
+            # Frames are written from a background thread so that disk I/O
+            # overlaps with the next force evaluation.
+            frames = queue.Queue(maxsize=8)
+            writer = threading.Thread(
+                target=_write_frames,
+                args=(frames, trajectories, write_errors),
+                daemon=True,
             )
-            converged = torch.all(torch.logical_not(update_mask))
-            # GPU memory usage as per nvidia-smi seems to gradually build up as
-            # batches are processed. This releases unoccupied cached memory.
-            torch.cuda.empty_cache()
+            writer.start()
 
-        if trajectories is not None:
-            for traj in trajectories:
-                traj.close()
+        try:
+            iteration = 0
+            converged = False
+            while iteration < steps and not converged:
+                r0, f0, e0 = self.step(
+                    iteration, r0, f0, H0, s, y, sy, q, z, update_mask
+                )
+                iteration += 1
+                if trajectories is not None:
+                    self.atoms.y, self.atoms.force = e0, f0
+                    # batch_to_atoms copies everything to the host, so the
+                    # writer never touches tensors that later steps update.
+                    atoms_objects = batch_to_atoms(self.atoms)
+                    # One device-to-host copy for whether each system is
+                    # still being relaxed, rather than one per system.
+                    active = update_mask.index_select(
+                        0, self._first_atom
+                    ).tolist()
+                    frames.put((atoms_objects, active))
+                update_mask, converged = self.check_convergence(
+                    iteration, update_mask, f0, fmax, steps
+                )
+                # GPU memory usage as per nvidia-smi seems to gradually build
+                # up as batches are processed. Releasing unoccupied cached
+                # memory forces a device sync and later re-allocation, so it
+                # is opt-in.
+                if self.release_cache:
+                    torch.cuda.empty_cache()
+        finally:
+            if writer is not None:
+                frames.put(None)
+                writer.join()
+                for traj in trajectories:
+                    traj.close()
+        if write_errors:
+            raise write_errors[0]
 
         self.atoms.y, self.atoms.force = self.get_forces(
             apply_constraint=False
         )
         return self.atoms
 
-    def step(self, iteration, r0, f0, H0, rho, s, y, update_mask):
+    def step(self, iteration, r0, f0, H0, s, y, sy, q, z, update_mask):
         def determine_step(dr):
             steplengths = torch.norm(dr, dim=1)
             longest_steps = scatter(
-                steplengths, self.atoms.batch, reduce="max"
+                steplengths,
+                self._batch_indices,
+                dim=0,
+                dim_size=self._n_systems,
+                reduce="max",
             )
-            longest_steps = longest_steps[self.atoms.batch]
-            maxstep = longest_steps.new_tensor(self.maxstep)
-            scale = (longest_steps + 1e-7).reciprocal() * torch.min(
-                longest_steps, maxstep
-            )
-            dr *= scale.unsqueeze(1)
-            return dr * self.damping
+            longest_steps = longest_steps.index_select(0, self._batch_indices)
+            return _clip_step(dr, longest_steps, self.maxstep, self.damping)
 
         e, f = self.get_forces()
-        f = f.to(self.device, dtype=torch.float64)
-        r = self.atoms.pos.to(self.device, dtype=torch.float64)
-
-        # Update s, y and rho
-        if iteration > 0:
-            s0 = (r - r0).flatten()
-            y0 = -(f - f0).flatten()
-            s.append(s0)
-            y.append(y0)
-            rho.append(1.0 / torch.dot(y0, s0))
-
-        loopmax = min(self.memory, iteration)
-        alpha = f.new_empty(loopmax)
-        q = -f.flatten()
-
-        for i in range(loopmax - 1, -1, -1):
-            alpha[i] = rho[i] * torch.dot(s[i], q)
-            q -= alpha[i] * y[i]
-        z = H0 * q
-        for i in range(loopmax):
-            beta = rho[i] * torch.dot(y[i], z)
-            z += s[i] * (alpha[i] - beta)
-        p = -z.reshape((-1, 3))  # descent direction
+        # Force models set requires_grad on the positions and may return
+        # forces that are part of a graph; the optimizer state must not be.
+        r = self.atoms.pos.detach().to(self.device)
+        f = f.detach().to(self.device, dtype=r.dtype)
+
+        # Update s, y and their dot products
+        memory = sy.size(0)
+        count = min(memory, iteration)
+        start = 0
+        if count > 0:
+            # Overwrite the oldest row once the buffers are full.
+            head = (iteration - 1) % memory
+            torch.sub(r, r0, out=s[head].view_as(r))
+            torch.sub(f0, f, out=y[head].view_as(f))
+            start = (iteration - count) % memory
+            # Refresh the row and column of s . y pairs touching the new entry.
+            sy[head, :count] = torch.mv(y[:count], s[head])
+            sy[:count, head] = torch.mv(s[:count], y[head])
+
+            if self.scale_H0:
+                # Scale the initial inverse Hessian by s.y / y.y of the newest
+                # pair (Nocedal & Wright, eq. 7.20), keeping 1 / alpha when
+                # the curvature condition s.y > 0 does not hold.
+                yy = torch.dot(y[head], y[head]).to(sy.dtype)
+                H0 = torch.where(
+                    sy[head, head] > 0, sy[head, head] / yy, H0.to(sy.dtype)
+                )
+
+        torch.neg(f.reshape(-1), out=q)
+        z = _two_loop_recursion(q, z, s, y, sy, start, count, H0)
+        p = z.view(-1, 3).neg_()  # descent direction
         dr = determine_step(p)
         if torch.abs(dr).max() < 1e-7:
             # Same configuration again (maybe a restart):
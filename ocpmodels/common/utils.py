@@ -15,6 +15,7 @@ import json
 import logging
 import math
 import os
+import subprocess
 import sys
 import time
 from bisect import bisect
@@ -254,6 +255,10 @@ def setup_imports():
                     "ocpmodels.%s.%s" % (key[1:], module_name)
                 )
 
+    # GemNet lives in a subpackage that the glob above does not match, and
+    # ocpmodels.models no longer imports it eagerly.
+    importlib.import_module("ocpmodels.models.gemnet.gemnet")
+
     experimental_folder = os.path.join(root_folder, "../experimental/")
     if os.path.exists(experimental_folder):
         experimental_files = glob.glob(
@@ -411,11 +416,15 @@ def create_grid(base_config, sweep_file):
                 flat_sweeps.append((new_key, value))
         return collections.OrderedDict(flat_sweeps)
 
-    def _update_config(config, keys, override_vals, sep="."):
+    def _update_config(base_config, keys, override_vals, sep="."):
+        # Copy only the dictionaries along each overridden key path;
+        # untouched sub-configs are shared with base_config.
+        config = dict(base_config)
         for key, value in zip(keys, override_vals):
             key_path = key.split(sep)
             child_config = config
             for name in key_path[:-1]:
+                child_config[name] = dict(child_config[name])
                 child_config = child_config[name]
             child_config[key_path[-1]] = value
         return config
@@ -427,13 +436,48 @@ def create_grid(base_config, sweep_file):
 
     configs = []
     for i, override_vals in enumerate(values):
-        config = copy.deepcopy(base_config)
-        config = _update_config(config, keys, override_vals)
+        config = _update_config(base_config, keys, override_vals)
         config["identifier"] = config["identifier"] + f"_run{i}"
         configs.append(config)
     return configs
 
 
+def get_commit_hash():
+    """
+    Return the commit hash of the ocpmodels checkout, or None if the code is
+    not being run from a git repository. Reads .git/HEAD directly to avoid
+    spawning a git process, falling back to `git describe` if that fails.
+    """
+    root = Path(__file__).resolve().parents[2]
+    git_dir = root / ".git"
+    try:
+        head = (git_dir / "HEAD").read_text().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[len("ref: ") :]
+        ref_path = git_dir / ref
+        if ref_path.is_file():
+            return ref_path.read_text().strip()
+        for line in (git_dir / "packed-refs").read_text().splitlines():
+            if line.endswith(f" {ref}"):
+                return line.split(" ", 1)[0]
+    except OSError:
+        pass
+
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "-C", str(root), "describe", "--always"],
+                stderr=subprocess.DEVNULL,
+            )
+            .strip()
+            .decode("ascii")
+        )
+    # catch instances where code is not being run from a git repo
+    except Exception:
+        return None
+
+
 def save_experiment_log(args, jobs, configs):
     log_file = args.logdir / "exp" / time.strftime("%Y-%m-%d-%I-%M-%S%p.log")
     log_file.parent.mkdir(exist_ok=True, parents=True)
@@ -697,7 +741,8 @@ def merge_dicts(dict1: dict, dict2: dict):
     """Recursively merge two dictionaries.
     Values in dict2 override values in dict1. If dict1 and dict2 contain a dictionary as a
     value, this will call itself recursively to merge these dictionaries.
-    This does not modify the input dictionaries (creates an internal copy).
+    This does not modify the input dictionaries. Only sub-dictionaries present
+    in both inputs are copied; all other values are shared with the inputs.
     Additionally returns a list of detected duplicates.
     Adapted from https://github.com/TUM-DAML/seml/blob/master/seml/utils.py
 
@@ -718,21 +763,31 @@ def merge_dicts(dict1: dict, dict2: dict):
     if not isinstance(dict2, dict):
         raise ValueError(f"Expecting dict2 to be dict, found {type(dict2)}.")
 
-    return_dict = copy.deepcopy(dict1)
+    return_dict = dict(dict1)
+    duplicates = _merge_into(return_dict, dict2)
+
+    return return_dict, duplicates
+
+
+def _merge_into(dst: dict, src: dict):
+    """
+    Merge src into dst in place, copying a sub-dictionary of dst only when
+    src overrides some of its keys. Returns the list of duplicate keys.
+    """
     duplicates = []
 
-    for k, v in dict2.items():
-        if k not in dict1:
-            return_dict[k] = v
+    for k, v in src.items():
+        if k not in dst:
+            dst[k] = v
+        elif isinstance(v, dict) and isinstance(dst[k], dict):
+            dst[k] = dict(dst[k])
+            duplicates_k = _merge_into(dst[k], v)
+            duplicates += [f"{k}.{dup}" for dup in duplicates_k]
         else:
-            if isinstance(v, dict) and isinstance(dict1[k], dict):
-                return_dict[k], duplicates_k = merge_dicts(dict1[k], dict2[k])
-                duplicates += [f"{k}.{dup}" for dup in duplicates_k]
-            else:
-                return_dict[k] = dict2[k]
-                duplicates.append(k)
+            dst[k] = v
+            duplicates.append(k)
 
-    return return_dict, duplicates
+    return duplicates
 
 
 class SeverityLevelBetween(logging.Filter):
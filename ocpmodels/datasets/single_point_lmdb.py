@@ -37,17 +37,24 @@ class SinglePointLmdbDataset(Dataset):
 
         self.env = self.connect_db(self.db_path)
 
-        self._keys = [
-            f"{j}".encode("ascii") for j in range(self.env.stat()["entries"])
-        ]
+        self.num_samples = self.env.stat()["entries"]
         self.transform = transform
 
     def __len__(self):
-        return len(self._keys)
+        return self.num_samples
 
     def __getitem__(self, idx):
+        # Keys are 0..num_samples-1. Index like a sequence: negative indices
+        # count from the end, and IndexError ends plain iteration.
+        if not -self.num_samples <= idx < self.num_samples:
+            raise IndexError(f"index {idx} out of range")
+        if idx < 0:
+            idx += self.num_samples
+
         # Return features.
-        datapoint_pickled = self.env.begin().get(self._keys[idx])
+        datapoint_pickled = self.env.begin().get(f"{idx}".encode("ascii"))
+        if datapoint_pickled is None:
+            raise KeyError(f"no entry for index {idx} in {self.db_path}")
         data_object = pickle.loads(datapoint_pickled)
         data_object = (
             data_object
@@ -8,6 +8,7 @@ LICENSE file in the root directory of this source tree.
 import bisect
 import logging
 import math
+import os
 import pickle
 import random
 from pathlib import Path
@@ -42,15 +43,17 @@ class TrajectoryLmdbDataset(Dataset):
         db_paths = sorted(srcdir.glob("*.lmdb"))
         assert len(db_paths) > 0, f"No LMDBs found in {srcdir}"
 
-        self._keys, self.envs = [], []
+        self.db_paths = db_paths
+        self.envs, self._txns = [], []
+        self._pid = os.getpid()
+        keylens = []
         for db_path in db_paths:
             self.envs.append(self.connect_db(db_path))
-            length = pickle.loads(
-                self.envs[-1].begin().get("length".encode("ascii"))
+            self._txns.append(self.envs[-1].begin(buffers=True))
+            keylens.append(
+                pickle.loads(self._txns[-1].get("length".encode("ascii")))
             )
-            self._keys.append(list(range(length)))
 
-        keylens = [len(k) for k in self._keys]
         self._keylen_cumulative = np.cumsum(keylens).tolist()
         self.transform = transform
         self.num_samples = sum(keylens)
@@ -67,11 +70,9 @@ class TrajectoryLmdbDataset(Dataset):
             el_idx = idx - self._keylen_cumulative[db_idx - 1]
         assert el_idx >= 0
 
-        # Return features.
-        datapoint_pickled = (
-            self.envs[db_idx]
-            .begin()
-            .get(f"{self._keys[db_idx][el_idx]}".encode("ascii"))
+        # Return features. Keys within each db are 0..length-1.
+        datapoint_pickled = self._get_txn(db_idx).get(
+            f"{el_idx}".encode("ascii")
         )
         data_object = pickle.loads(datapoint_pickled)
         if self.transform is not None:
@@ -81,6 +82,22 @@ class TrajectoryLmdbDataset(Dataset):
 
         return data_object
 
+    def _get_txn(self, db_idx):
+        # LMDB environments must not be shared across fork(), so DataLoader
+        # workers drop the handles inherited from the parent and lazily open
+        # their own. Each environment keeps a single read transaction that is
+        # reused for every sample; with buffers=True, values are memoryviews
+        # into the memory map that pickle.loads reads without an extra copy.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.envs = [None] * len(self.db_paths)
+            self._txns = [None] * len(self.db_paths)
+
+        if self._txns[db_idx] is None:
+            self.envs[db_idx] = self.connect_db(self.db_paths[db_idx])
+            self._txns[db_idx] = self.envs[db_idx].begin(buffers=True)
+        return self._txns[db_idx]
+
     def connect_db(self, lmdb_path=None):
         env = lmdb.open(
             str(lmdb_path),
@@ -95,7 +112,10 @@ class TrajectoryLmdbDataset(Dataset):
 
     def close_db(self):
         for env in self.envs:
-            env.close()
+            if env is not None:
+                env.close()
+        self.envs = [None] * len(self.db_paths)
+        self._txns = [None] * len(self.db_paths)
 
 
 def data_list_collater(data_list, otf_graph=False):
@@ -103,11 +123,10 @@ def data_list_collater(data_list, otf_graph=False):
 
     if not otf_graph:
         try:
-            n_neighbors = []
-            for i, data in enumerate(data_list):
-                n_index = data.edge_index[1, :]
-                n_neighbors.append(n_index.shape[0])
-            batch.neighbors = torch.tensor(n_neighbors)
+            # Count edges per graph from the graph id of each edge's target.
+            batch.neighbors = torch.bincount(
+                batch.batch[batch.edge_index[1]], minlength=len(data_list)
+            )
         except NotImplementedError:
             logging.warning(
                 "LMDB does not contain edge index information, set otf_graph=True"
@@ -10,24 +10,33 @@ __all__ = [
     "DimeNetPlusPlus",
     "SchNet",
     "ForceNet",
+    "GemNetT",
 ]
 
-from .base import BaseModel
-from .cgcnn import CGCNN
-from .dimenet import DimeNetWrap as DimeNet
-from .dimenet_plus_plus import DimeNetPlusPlusWrap as DimeNetPlusPlus
-from .forcenet import ForceNet
-from .schnet import SchNetWrap as SchNet
-from .gemnet.gemnet import GemNetT
+import importlib
 
-DimeNet.__module__ = __name__
-DimeNet.__name__ = "DimeNet"
+# Models are imported lazily on first attribute access (PEP 562) so that
+# importing one model does not pull in the dependencies of all the others.
+_lazy_imports = {
+    "BaseModel": (".base", "BaseModel"),
+    "CGCNN": (".cgcnn", "CGCNN"),
+    "DimeNet": (".dimenet", "DimeNetWrap"),
+    "DimeNetPlusPlus": (".dimenet_plus_plus", "DimeNetPlusPlusWrap"),
+    "ForceNet": (".forcenet", "ForceNet"),
+    "SchNet": (".schnet", "SchNetWrap"),
+    "GemNetT": (".gemnet.gemnet", "GemNetT"),
+}
 
-DimeNetPlusPlus.__module__ = __name__
-DimeNetPlusPlus.__name__ = "DimeNetPlusPlus"
 
-SchNet.__module__ = __name__
-SchNet.__name__ = "SchNet"
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-ForceNet.__module__ = __name__
-ForceNet.__name__ = "ForceNet"
+    module_name, attr = _lazy_imports[name]
+    obj = getattr(importlib.import_module(module_name, __name__), attr)
+    globals()[name] = obj
+    return obj
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
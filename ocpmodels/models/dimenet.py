@@ -209,3 +209,8 @@ class DimeNetWrap(DimeNet):
     @property
     def num_params(self):
         return sum(p.numel() for p in self.parameters())
+
+
+# Exposed as ocpmodels.models.DimeNet.
+DimeNetWrap.__module__ = "ocpmodels.models"
+DimeNetWrap.__name__ = "DimeNet"
@@ -468,3 +468,8 @@ class DimeNetPlusPlusWrap(DimeNetPlusPlus):
     @property
     def num_params(self):
         return sum(p.numel() for p in self.parameters())
+
+
+# Exposed as ocpmodels.models.DimeNetPlusPlus.
+DimeNetPlusPlusWrap.__module__ = "ocpmodels.models"
+DimeNetPlusPlusWrap.__name__ = "DimeNetPlusPlus"
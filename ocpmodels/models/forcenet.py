@@ -520,3 +520,7 @@ class ForceNet(BaseModel):
     @property
     def num_params(self):
         return sum(p.numel() for p in self.parameters())
+
+
+# Exposed as ocpmodels.models.ForceNet.
+ForceNet.__module__ = "ocpmodels.models"
@@ -149,3 +149,8 @@ class SchNetWrap(SchNet):
     @property
     def num_params(self):
         return sum(p.numel() for p in self.parameters())
+
+
+# Exposed as ocpmodels.models.SchNet.
+SchNetWrap.__module__ = "ocpmodels.models"
+SchNetWrap.__name__ = "SchNet"
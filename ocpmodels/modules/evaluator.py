@@ -7,6 +7,7 @@ LICENSE file in the root directory of this source tree.
 
 import numpy as np
 import torch
+from torch_scatter import scatter
 
 
 """
@@ -23,9 +24,12 @@ perf = evaluator.eval(prediction, target)
 task: "s2ef", "is2rs", "is2re".
 
 We specify a default set of metrics for each task, but should be easy to extend
-to add more metrics. `evaluator.eval` takes as input two dictionaries, one for
-predictions and another for targets to check against. It returns a dictionary
-with the relevant metrics computed.
+to add more metrics (register new metric functions in `METRIC_FNS`; they are
+called as `fn(prediction, target, cache)`, where `cache` is a dict shared by
+all metrics of one `eval` call).
+`evaluator.eval` takes as input two dictionaries, one for predictions and
+another for targets to check against. It returns a dictionary with the
+relevant metrics computed.
 """
 
 
@@ -65,6 +69,7 @@ class Evaluator:
         assert task in ["s2ef", "is2rs", "is2re"]
         self.task = task
         self.metric_fn = self.task_metrics[task]
+        self._metric_fns = [(fn, METRIC_FNS[fn]) for fn in self.metric_fn]
 
     def eval(self, prediction, target, prev_metrics={}):
         for attr in self.task_attributes[self.task]:
@@ -74,8 +79,12 @@ class Evaluator:
 
         metrics = prev_metrics
 
-        for fn in self.task_metrics[self.task]:
-            res = eval(fn)(prediction, target)
+        # Metric functions share per-batch intermediates (e.g. the force
+        # error) through `cache` and return 0-d tensor totals, which `update`
+        # accumulates on device. Use `finalize` to copy them to the host.
+        cache = {}
+        for fn, metric_fn in self._metric_fns:
+            res = metric_fn(prediction, target, cache)
             metrics = self.update(fn, res, metrics)
 
         return metrics
@@ -90,7 +99,7 @@ class Evaluator:
 
         if isinstance(stat, dict):
             # If dictionary, we expect it to have `metric`, `total`, `numel`.
-            metrics[key]["total"] += stat["total"]
+            metrics[key]["total"] += _as_total(stat["total"])
             metrics[key]["numel"] += stat["numel"]
             metrics[key]["metric"] = (
                 metrics[key]["total"] / metrics[key]["numel"]
@@ -103,68 +112,118 @@ class Evaluator:
                 metrics[key]["total"] / metrics[key]["numel"]
             )
         elif torch.is_tensor(stat):
-            raise NotImplementedError
+            # A 0-d tensor is accumulated like a float, but stays on device.
+            assert stat.dim() == 0
+            metrics[key]["total"] += _as_total(stat)
+            metrics[key]["numel"] += 1
+            metrics[key]["metric"] = (
+                metrics[key]["total"] / metrics[key]["numel"]
+            )
 
         return metrics
 
+    def finalize(self, metrics):
+        """
+        Returns a copy of `metrics` with every `total` and `metric` converted
+        to a Python float. Totals accumulated as tensors are copied to the
+        host together, so this costs at most one device sync.
+        """
+        keys = list(metrics)
+        tensors = [
+            metrics[k]["total"]
+            for k in keys
+            if torch.is_tensor(metrics[k]["total"])
+        ]
+        values = iter(torch.stack(tensors).tolist() if tensors else [])
+
+        finalized = {}
+        for k in keys:
+            total = metrics[k]["total"]
+            total = next(values) if torch.is_tensor(total) else float(total)
+            numel = metrics[k]["numel"]
+            finalized[k] = {
+                "metric": total / numel if numel else None,
+                "total": total,
+                "numel": numel,
+            }
+        return finalized
+
 
-def energy_mae(prediction, target):
-    return absolute_error(prediction["energy"], target["energy"])
+def _as_total(total):
+    # Accumulate tensor totals in float64, as Python floats would be, so that
+    # long evaluations do not lose precision. Totals are computed from
+    # training predictions, so drop the autograd graph before keeping them.
+    if torch.is_tensor(total):
+        return total.detach().to(torch.float64)
+    return total
 
 
-def energy_mse(prediction, target):
-    return squared_error(prediction["energy"], target["energy"])
+def energy_mae(prediction, target, cache=None):
+    return _summed(_abs_error(prediction, target, "energy", cache))
 
 
-def forcesx_mae(prediction, target):
-    return absolute_error(prediction["forces"][:, 0], target["forces"][:, 0])
+def energy_mse(prediction, target, cache=None):
+    return _summed(_sq_error(prediction, target, "energy", cache))
 
 
-def forcesx_mse(prediction, target):
-    return squared_error(prediction["forces"][:, 0], target["forces"][:, 0])
+def forcesx_mae(prediction, target, cache=None):
+    return _summed(_abs_error(prediction, target, "forces", cache)[:, 0])
 
 
-def forcesy_mae(prediction, target):
-    return absolute_error(prediction["forces"][:, 1], target["forces"][:, 1])
+def forcesx_mse(prediction, target, cache=None):
+    return _summed(_sq_error(prediction, target, "forces", cache)[:, 0])
 
 
-def forcesy_mse(prediction, target):
-    return squared_error(prediction["forces"][:, 1], target["forces"][:, 1])
+def forcesy_mae(prediction, target, cache=None):
+    return _summed(_abs_error(prediction, target, "forces", cache)[:, 1])
 
 
-def forcesz_mae(prediction, target):
-    return absolute_error(prediction["forces"][:, 2], target["forces"][:, 2])
+def forcesy_mse(prediction, target, cache=None):
+    return _summed(_sq_error(prediction, target, "forces", cache)[:, 1])
 
 
-def forcesz_mse(prediction, target):
-    return squared_error(prediction["forces"][:, 2], target["forces"][:, 2])
+def forcesz_mae(prediction, target, cache=None):
+    return _summed(_abs_error(prediction, target, "forces", cache)[:, 2])
 
 
-def forces_mae(prediction, target):
-    return absolute_error(prediction["forces"], target["forces"])
+def forcesz_mse(prediction, target, cache=None):
+    return _summed(_sq_error(prediction, target, "forces", cache)[:, 2])
 
 
-def forces_mse(prediction, target):
-    return squared_error(prediction["forces"], target["forces"])
+def forces_mae(prediction, target, cache=None):
+    return _summed(_abs_error(prediction, target, "forces", cache))
 
 
-def forces_cos(prediction, target):
-    return cosine_similarity(prediction["forces"], target["forces"])
+def forces_mse(prediction, target, cache=None):
+    return _summed(_sq_error(prediction, target, "forces", cache))
 
 
-def forces_magnitude(prediction, target):
-    return magnitude_error(prediction["forces"], target["forces"], p=2)
+def forces_cos(prediction, target, cache=None):
+    # Reuse the force norms shared with forces_magnitude instead of having
+    # torch.cosine_similarity compute them again.
+    pred_norm, target_norm = _forces_norms(prediction, target, cache)
+    dot = torch.sum(prediction["forces"] * target["forces"], dim=-1)
+    eps = 1e-8
+    return _summed(
+        dot / (pred_norm.clamp_min(eps) * target_norm.clamp_min(eps))
+    )
+
 
+def forces_magnitude(prediction, target, cache=None):
+    assert prediction["forces"].shape[1] > 1
+    pred_norm, target_norm = _forces_norms(prediction, target, cache)
+    return _summed(torch.abs(pred_norm - target_norm))
 
-def positions_mae(prediction, target):
-    return absolute_error(prediction["positions"], target["positions"])
 
+def positions_mae(prediction, target, cache=None):
+    return _summed(_abs_error(prediction, target, "positions", cache))
 
-def positions_mse(prediction, target):
-    return squared_error(prediction["positions"], target["positions"])
 
+def positions_mse(prediction, target, cache=None):
+    return _summed(_sq_error(prediction, target, "positions", cache))
 
-def energy_force_within_threshold(prediction, target):
+
+def energy_force_within_threshold(prediction, target, cache=None):
     # Note that this natoms should be the count of free atoms we evaluate over.
     assert target["natoms"].sum() == prediction["forces"].size(0)
     assert target["natoms"].size(0) == prediction["energy"].size(0)
@@ -175,19 +234,22 @@ def energy_force_within_threshold(prediction, target):
     f_thresh = 0.03
     e_thresh = 0.02
 
-    success, total = 0.0, target["natoms"].size(0)
+    total = target["natoms"].size(0)
+
+    error_forces = _abs_error(prediction, target, "forces", cache)
+    error_energy = _abs_error(prediction, target, "energy", cache)
 
-    error_forces = torch.abs(target["forces"] - prediction["forces"])
-    error_energy = torch.abs(target["energy"] - prediction["energy"])
+    # max force error per system, reduced over all atoms of each system.
+    batch_idx = _batch_idx(target, error_forces.device)
+    max_error_forces = scatter(
+        error_forces.amax(dim=1),
+        batch_idx,
+        dim=0,
+        dim_size=total,
+        reduce="max",
+    )
 
-    start_idx = 0
-    for i, n in enumerate(target["natoms"]):
-        if (
-            error_energy[i] < e_thresh
-            and error_forces[start_idx : start_idx + n].max() < f_thresh
-        ):
-            success += 1
-        start_idx += n
+    success = ((error_energy < e_thresh) & (max_error_forces < f_thresh)).sum()
 
     return {
         "metric": success / total,
@@ -196,13 +258,13 @@ def energy_force_within_threshold(prediction, target):
     }
 
 
-def energy_within_threshold(prediction, target):
+def energy_within_threshold(prediction, target, cache=None):
     # compute absolute error on energy per system.
     # then count the no. of systems where max energy error is < 0.02.
     e_thresh = 0.02
-    error_energy = torch.abs(target["energy"] - prediction["energy"])
+    error_energy = _abs_error(prediction, target, "energy", cache)
 
-    success = (error_energy < e_thresh).sum().item()
+    success = (error_energy < e_thresh).sum()
     total = target["energy"].size(0)
 
     return {
@@ -212,87 +274,151 @@ def energy_within_threshold(prediction, target):
     }
 
 
-def average_distance_within_threshold(prediction, target):
-    pred_pos = torch.split(
-        prediction["positions"], prediction["natoms"].tolist()
+# Thresholds of average_distance_within_threshold. They are built with numpy,
+# as before: torch.arange differs from np.arange in the last bit for most of
+# them, which changes the count for distances that land on one.
+_DISTANCE_THRESHOLDS = torch.tensor(
+    np.arange(0.01, 0.5, 0.001), dtype=torch.float64
+)
+
+
+def average_distance_within_threshold(prediction, target, cache=None):
+    pred_pos = prediction["positions"]
+    n_systems = target["natoms"].size(0)
+
+    # Evaluate all systems at once on a flat (n_atoms, 3) layout, with each
+    # atom paired with the cell of the system it belongs to.
+    batch_idx = _batch_idx(target, pred_pos.device)
+    distances = torch.norm(
+        min_diff(
+            pred_pos.detach(),
+            target["positions"].detach(),
+            target["cell"].detach(),
+            target["pbc"].to(pred_pos.device),
+            batch_idx,
+        ),
+        dim=1,
+    )
+    mean_distance = scatter(
+        distances, batch_idx, dim=0, dim_size=n_systems, reduce="mean"
     )
-    target_pos = torch.split(target["positions"], target["natoms"].tolist())
-
-    mean_distance = []
-    for idx, ml_pos in enumerate(pred_pos):
-        mean_distance.append(
-            np.mean(
-                np.linalg.norm(
-                    min_diff(
-                        ml_pos.detach().cpu().numpy(),
-                        target_pos[idx].detach().cpu().numpy(),
-                        target["cell"][idx].detach().cpu().numpy(),
-                        target["pbc"].tolist(),
-                    ),
-                    axis=1,
-                )
-            )
-        )
 
-    success = 0
-    intv = np.arange(0.01, 0.5, 0.001)
-    for i in intv:
-        success += sum(np.array(mean_distance) < i)
+    # Count (system, threshold) pairs with mean_distance < threshold: for
+    # each system, that is the number of thresholds strictly above it.
+    intv = _DISTANCE_THRESHOLDS.to(pred_pos.device)
+    success = (
+        len(intv) * n_systems
+        - torch.searchsorted(
+            intv, mean_distance.to(torch.float64), right=True
+        ).sum()
+    )
 
-    total = len(mean_distance) * len(intv)
+    total = n_systems * len(intv)
 
     return {"metric": success / total, "total": success, "numel": total}
 
 
-def min_diff(pred_pos, dft_pos, cell, pbc):
+def _batch_idx(target, device):
+    """
+    System index of each atom. Callers that already have it, e.g. from the
+    `batch` vector of a batch, pass it as target["batch_idx"]. Otherwise it
+    is built from natoms, which needs a host sync to size the output.
+    """
+    if "batch_idx" in target:
+        return target["batch_idx"].to(device)
+    natoms = target["natoms"].to(device)
+    return torch.repeat_interleave(
+        torch.arange(natoms.size(0), device=device), natoms
+    )
+
+
+def min_diff(pred_pos, dft_pos, cell, pbc, batch_idx):
+    """
+    Minimum image displacement between pred_pos and dft_pos, both (n, 3).
+    cell holds the (n_systems, 3, 3) cells, batch_idx the system of each atom
+    and pbc a (3,) boolean tensor of periodic directions.
+    """
     pos_diff = pred_pos - dft_pos
-    fractional = np.linalg.solve(cell.T, pos_diff.T).T
+    # Invert each 3x3 cell once per system rather than solving per atom.
+    inv_cell = torch.inverse(cell)
+    fractional = torch.einsum("ni,nij->nj", pos_diff, inv_cell[batch_idx])
+
+    # A single x - floor(x) wraps into [0, 1]; values landing on 1.0 from
+    # rounding are moved back by the > 0.5 shift below.
+    fractional = torch.where(
+        pbc, fractional - torch.floor(fractional), fractional
+    )
+    fractional = torch.where(fractional > 0.5, fractional - 1, fractional)
 
-    for i, periodic in enumerate(pbc):
-        # Yes, we need to do it twice
-        if periodic:
-            fractional[:, i] %= 1.0
-            fractional[:, i] %= 1.0
+    return torch.einsum("ni,nij->nj", fractional, cell[batch_idx])
 
-    fractional[fractional > 0.5] -= 1
 
-    return np.matmul(fractional, cell)
+def _error(prediction, target, key, cache):
+    # Signed error on `key`, computed once per `Evaluator.eval` call and shared
+    # by every metric that reads it through `cache`.
+    if cache is None:
+        cache = {}
+    if (key, "error") not in cache:
+        cache[key, "error"] = target[key] - prediction[key]
+    return cache[key, "error"]
 
 
-def cosine_similarity(prediction, target):
-    error = torch.cosine_similarity(prediction, target)
-    return {
-        "metric": torch.mean(error).item(),
-        "total": torch.sum(error).item(),
-        "numel": error.numel(),
-    }
+def _abs_error(prediction, target, key, cache):
+    if cache is None:
+        cache = {}
+    if (key, "abs") not in cache:
+        cache[key, "abs"] = torch.abs(_error(prediction, target, key, cache))
+    return cache[key, "abs"]
 
 
-def absolute_error(prediction, target):
-    error = torch.abs(target - prediction)
-    return {
-        "metric": torch.mean(error).item(),
-        "total": torch.sum(error).item(),
-        "numel": prediction.numel(),
-    }
+def _sq_error(prediction, target, key, cache):
+    if cache is None:
+        cache = {}
+    if (key, "sq") not in cache:
+        error = _error(prediction, target, key, cache)
+        cache[key, "sq"] = error * error
+    return cache[key, "sq"]
 
 
-def squared_error(prediction, target):
-    error = (target - prediction) ** 2
-    return {
-        "metric": torch.mean(error).item(),
-        "total": torch.sum(error).item(),
-        "numel": prediction.numel(),
-    }
+def _forces_norms(prediction, target, cache):
+    if cache is None:
+        cache = {}
+    if ("forces", "norms") not in cache:
+        cache["forces", "norms"] = (
+            torch.norm(prediction["forces"], p=2, dim=-1),
+            torch.norm(target["forces"], p=2, dim=-1),
+        )
+    return cache["forces", "norms"]
 
 
-def magnitude_error(prediction, target, p=2):
-    assert prediction.shape[1] > 1
-    error = torch.abs(
-        torch.norm(prediction, p=p, dim=-1) - torch.norm(target, p=p, dim=-1)
-    )
+def _summed(error):
+    total = torch.sum(error)
     return {
-        "metric": torch.mean(error).item(),
-        "total": torch.sum(error).item(),
+        "metric": total / error.numel(),
+        "total": total,
         "numel": error.numel(),
     }
+
+
+METRIC_FNS = {
+    fn.__name__: fn
+    for fn in [
+        energy_mae,
+        energy_mse,
+        forcesx_mae,
+        forcesx_mse,
+        forcesy_mae,
+        forcesy_mse,
+        forcesz_mae,
+        forcesz_mse,
+        forces_mae,
+        forces_mse,
+        forces_cos,
+        forces_magnitude,
+        positions_mae,
+        positions_mse,
+        energy_force_within_threshold,
+        energy_within_threshold,
+        average_distance_within_threshold,
+    ]
+}
@@ -7,10 +7,9 @@ class L2MAELoss(nn.Module):
         super().__init__()
         self.reduction = reduction
         assert reduction in ["mean", "sum"]
+        # Resolve the reduction once instead of branching on every call.
+        self._reduce = torch.mean if reduction == "mean" else torch.sum
 
     def forward(self, input: torch.Tensor, target: torch.Tensor):
         dists = torch.norm(input - target, p=2, dim=-1)
-        if self.reduction == "mean":
-            return torch.mean(dists)
-        elif self.reduction == "sum":
-            return torch.sum(dists)
+        return self._reduce(dists)
@@ -10,7 +10,6 @@ import json
 import logging
 import os
 import random
-import subprocess
 from abc import ABC, abstractmethod
 from collections import OrderedDict, defaultdict
 from pathlib import Path
@@ -24,13 +23,13 @@ from ray import tune
 from torch.nn.parallel.distributed import DistributedDataParallel
 from tqdm import tqdm
 
-import ocpmodels
 from ocpmodels.common import distutils
 from ocpmodels.common.data_parallel import OCPDataParallel
 from ocpmodels.common.meter import Meter
 from ocpmodels.common.registry import registry
 from ocpmodels.common.utils import (
     build_config,
+    get_commit_hash,
     plot_histogram,
     save_checkpoint,
     tune_reporter,
@@ -99,28 +98,14 @@ class BaseTrainer(ABC):
         else:
             self.timestamp_id = timestamp_id
 
-        try:
-            commit_hash = (
-                subprocess.check_output(
-                    [
-                        "git",
-                        "-C",
-                        ocpmodels.__path__[0],
-                        "describe",
-                        "--always",
-                    ]
-                )
-                .strip()
-                .decode("ascii")
-            )
-        # catch instances where code is not being run from a git repo
-        except Exception:
-            commit_hash = None
+        commit_hash = get_commit_hash()
 
         self.config = {
             "task": task,
-            "model": model.pop("name"),
-            "model_attributes": model,
+            "model": model["name"],
+            "model_attributes": {
+                k: v for k, v in model.items() if k != "name"
+            },
             "optim": optimizer,
             "logger": logger,
             "amp": amp,
@@ -464,6 +449,7 @@ class BaseTrainer(ABC):
             self.hpo_checkpoint_every,
         )
         # report metrics to tune
+        train_metrics = self.evaluator.finalize(train_metrics)
         tune_reporter(
             iters=progress,
             train_metrics={
@@ -508,22 +494,9 @@ class BaseTrainer(ABC):
 
             # Compute metrics.
             metrics = self._compute_metrics(out, batch, evaluator, metrics)
-            metrics = evaluator.update("loss", loss.item(), metrics)
+            metrics = evaluator.update("loss", loss.detach(), metrics)
 
-        aggregated_metrics = {}
-        for k in metrics:
-            aggregated_metrics[k] = {
-                "total": distutils.all_reduce(
-                    metrics[k]["total"], average=False, device=self.device
-                ),
-                "numel": distutils.all_reduce(
-                    metrics[k]["numel"], average=False, device=self.device
-                ),
-            }
-            aggregated_metrics[k]["metric"] = (
-                aggregated_metrics[k]["total"] / aggregated_metrics[k]["numel"]
-            )
-        metrics = aggregated_metrics
+        metrics = self._aggregate_metrics(evaluator.finalize(metrics))
 
         log_dict = {k: metrics[k]["metric"] for k in metrics}
         log_dict.update({"epoch": self.epoch})
@@ -544,6 +517,52 @@ class BaseTrainer(ABC):
 
         return metrics
 
+    def _cat_batch_field(self, batch_list, field):
+        # Concatenate a per-batch field on the training device. With a single
+        # sub-batch (one GPU or CPU) the torch.cat copy is skipped.
+        tensors = [
+            getattr(batch, field).to(self.device, non_blocking=True)
+            for batch in batch_list
+        ]
+        if len(tensors) == 1:
+            return tensors[0]
+        return torch.cat(tensors, dim=0)
+
+    def _cat_batch_idx(self, batch_list):
+        # System index of each atom across all sub-batches, built from the
+        # `batch` vector each of them carries. The offsets are host-side
+        # system counts, so this does not sync with the device.
+        batch_idx, offset = [], 0
+        for batch in batch_list:
+            batch_idx.append(
+                batch.batch.to(self.device, non_blocking=True) + offset
+            )
+            offset += batch.natoms.numel()
+        if len(batch_idx) == 1:
+            return batch_idx[0]
+        return torch.cat(batch_idx, dim=0)
+
+    def _aggregate_metrics(self, metrics):
+        # Sum every metric's total and numel across ranks with a single
+        # collective. float64 keeps large numel counts exact.
+        keys = list(metrics)
+        stats = torch.tensor(
+            [[metrics[k]["total"], metrics[k]["numel"]] for k in keys],
+            dtype=torch.float64,
+        )
+        stats = distutils.all_reduce(
+            stats, average=False, device=self.device
+        ).tolist()
+
+        aggregated_metrics = {}
+        for k, (total, numel) in zip(keys, stats):
+            aggregated_metrics[k] = {
+                "total": total,
+                "numel": int(numel),
+                "metric": total / numel,
+            }
+        return aggregated_metrics
+
     @abstractmethod
     def _forward(self, batch_list):
         """Derived classes should implement this function."""
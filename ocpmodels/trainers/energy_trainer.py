@@ -292,11 +292,14 @@ class EnergyTrainer(BaseTrainer):
                     metrics={},
                 )
                 self.metrics = self.evaluator.update(
-                    "loss", loss.item() / scale, self.metrics
+                    "loss", loss.detach() / scale, self.metrics
                 )
 
                 # Log metrics.
-                log_dict = {k: self.metrics[k]["metric"] for k in self.metrics}
+                log_dict = {
+                    k: v["metric"]
+                    for k, v in self.evaluator.finalize(self.metrics).items()
+                }
                 log_dict.update(
                     {
                         "lr": self.scheduler.get_lr(),
@@ -395,9 +398,7 @@ class EnergyTrainer(BaseTrainer):
         }
 
     def _compute_loss(self, out, batch_list):
-        energy_target = torch.cat(
-            [batch.y_relaxed.to(self.device) for batch in batch_list], dim=0
-        )
+        energy_target = self._cat_batch_field(batch_list, "y_relaxed")
 
         if self.normalizer.get("normalize_labels", False):
             target_normed = self.normalizers["target"].norm(energy_target)
@@ -408,9 +409,7 @@ class EnergyTrainer(BaseTrainer):
         return loss
 
     def _compute_metrics(self, out, batch_list, evaluator, metrics={}):
-        energy_target = torch.cat(
-            [batch.y_relaxed.to(self.device) for batch in batch_list], dim=0
-        )
+        energy_target = self._cat_batch_field(batch_list, "y_relaxed")
 
         if self.normalizer.get("normalize_labels", False):
             out["energy"] = self.normalizers["target"].denorm(out["energy"])
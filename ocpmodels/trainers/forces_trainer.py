@@ -445,11 +445,14 @@ class ForcesTrainer(BaseTrainer):
                     self.metrics,
                 )
                 self.metrics = self.evaluator.update(
-                    "loss", loss.item() / scale, self.metrics
+                    "loss", loss.detach() / scale, self.metrics
                 )
 
                 # Log metrics.
-                log_dict = {k: self.metrics[k]["metric"] for k in self.metrics}
+                log_dict = {
+                    k: v["metric"]
+                    for k, v in self.evaluator.finalize(self.metrics).items()
+                }
                 log_dict.update(
                     {
                         "lr": self.scheduler.get_lr(),
@@ -546,9 +549,7 @@ class ForcesTrainer(BaseTrainer):
         loss = []
 
         # Energy loss.
-        energy_target = torch.cat(
-            [batch.y.to(self.device) for batch in batch_list], dim=0
-        )
+        energy_target = self._cat_batch_field(batch_list, "y")
         if self.normalizer.get("normalize_labels", False):
             energy_target = self.normalizers["target"].norm(energy_target)
         energy_mult = self.config["optim"].get("energy_coefficient", 1)
@@ -558,9 +559,7 @@ class ForcesTrainer(BaseTrainer):
 
         # Force loss.
         if self.config["model_attributes"].get("regress_forces", True):
-            force_target = torch.cat(
-                [batch.force.to(self.device) for batch in batch_list], dim=0
-            )
+            force_target = self._cat_batch_field(batch_list, "force")
             if self.normalizer.get("normalize_labels", False):
                 force_target = self.normalizers["grad_target"].norm(
                     force_target
@@ -573,17 +572,14 @@ class ForcesTrainer(BaseTrainer):
                 # handle tag specific weights as introduced in forcenet
                 assert len(tag_specific_weights) == 3
 
-                batch_tags = torch.cat(
-                    [
-                        batch.tags.float().to(self.device)
-                        for batch in batch_list
-                    ],
-                    dim=0,
-                )
-                weight = torch.zeros_like(batch_tags)
-                weight[batch_tags == 0] = tag_specific_weights[0]
-                weight[batch_tags == 1] = tag_specific_weights[1]
-                weight[batch_tags == 2] = tag_specific_weights[2]
+                # Look up per-atom weights by tag in a single gather instead
+                # of one compare and masked write per tag.
+                batch_tags = self._cat_batch_field(batch_list, "tags")
+                weight = torch.tensor(
+                    tag_specific_weights,
+                    dtype=torch.float,
+                    device=self.device,
+                )[batch_tags.long()]
 
                 loss_force_list = torch.abs(out["forces"] - force_target)
                 train_loss_force_unnormalized = torch.sum(
@@ -604,9 +600,7 @@ class ForcesTrainer(BaseTrainer):
                 # Force coefficient = 30 has been working well for us.
                 force_mult = self.config["optim"].get("force_coefficient", 30)
                 if self.config["task"].get("train_on_free_atoms", False):
-                    fixed = torch.cat(
-                        [batch.fixed.to(self.device) for batch in batch_list]
-                    )
+                    fixed = self._cat_batch_field(batch_list, "fixed")
                     mask = fixed == 0
                     loss.append(
                         force_mult
@@ -627,39 +621,30 @@ class ForcesTrainer(BaseTrainer):
         return loss
 
     def _compute_metrics(self, out, batch_list, evaluator, metrics={}):
-        natoms = torch.cat(
-            [batch.natoms.to(self.device) for batch in batch_list], dim=0
-        )
+        natoms = self._cat_batch_field(batch_list, "natoms")
+        batch_idx = self._cat_batch_idx(batch_list)
 
         target = {
-            "energy": torch.cat(
-                [batch.y.to(self.device) for batch in batch_list], dim=0
-            ),
-            "forces": torch.cat(
-                [batch.force.to(self.device) for batch in batch_list], dim=0
-            ),
+            "energy": self._cat_batch_field(batch_list, "y"),
+            "forces": self._cat_batch_field(batch_list, "force"),
             "natoms": natoms,
+            "batch_idx": batch_idx,
         }
 
         out["natoms"] = natoms
 
         if self.config["task"].get("eval_on_free_atoms", True):
-            fixed = torch.cat(
-                [batch.fixed.to(self.device) for batch in batch_list]
-            )
+            fixed = self._cat_batch_field(batch_list, "fixed")
             mask = fixed == 0
             out["forces"] = out["forces"][mask]
             target["forces"] = target["forces"][mask]
 
-            s_idx = 0
-            natoms_free = []
-            for natoms in target["natoms"]:
-                natoms_free.append(
-                    torch.sum(mask[s_idx : s_idx + natoms]).item()
-                )
-                s_idx += natoms
-            target["natoms"] = torch.LongTensor(natoms_free).to(self.device)
-            out["natoms"] = torch.LongTensor(natoms_free).to(self.device)
+            # Count free atoms per system in one pass over all atoms.
+            batch_idx = batch_idx[mask]
+            natoms_free = torch.bincount(batch_idx, minlength=natoms.size(0))
+            target["natoms"] = natoms_free
+            target["batch_idx"] = batch_idx
+            out["natoms"] = natoms_free
 
         if self.normalizer.get("normalize_labels", False):
             out["energy"] = self.normalizers["target"].denorm(out["energy"])
@@ -717,20 +702,18 @@ class ForcesTrainer(BaseTrainer):
 
             if split == "val":
                 mask = relaxed_batch.fixed == 0
-                s_idx = 0
-                natoms_free = []
-                for natoms in relaxed_batch.natoms:
-                    natoms_free.append(
-                        torch.sum(mask[s_idx : s_idx + natoms]).item()
-                    )
-                    s_idx += natoms
+                batch_idx = relaxed_batch.batch[mask]
+                natoms_free = torch.bincount(
+                    batch_idx, minlength=relaxed_batch.natoms.size(0)
+                )
 
                 target = {
                     "energy": relaxed_batch.y_relaxed,
                     "positions": relaxed_batch.pos_relaxed[mask],
                     "cell": relaxed_batch.cell,
                     "pbc": torch.tensor([True, True, True]),
-                    "natoms": torch.LongTensor(natoms_free),
+                    "natoms": natoms_free,
+                    "batch_idx": batch_idx,
                 }
 
                 prediction = {
@@ -738,7 +721,7 @@ class ForcesTrainer(BaseTrainer):
                     "positions": relaxed_batch.pos[mask],
                     "cell": relaxed_batch.cell,
                     "pbc": torch.tensor([True, True, True]),
-                    "natoms": torch.LongTensor(natoms_free),
+                    "natoms": natoms_free,
                 }
 
                 metrics = evaluator.eval(prediction, target, metrics)
@@ -793,21 +776,7 @@ class ForcesTrainer(BaseTrainer):
                 np.savez_compressed(full_path, **gather_results)
 
         if split == "val":
-            aggregated_metrics = {}
-            for k in metrics:
-                aggregated_metrics[k] = {
-                    "total": distutils.all_reduce(
-                        metrics[k]["total"], average=False, device=self.device
-                    ),
-                    "numel": distutils.all_reduce(
-                        metrics[k]["numel"], average=False, device=self.device
-                    ),
-                }
-                aggregated_metrics[k]["metric"] = (
-                    aggregated_metrics[k]["total"]
-                    / aggregated_metrics[k]["numel"]
-                )
-            metrics = aggregated_metrics
+            metrics = self._aggregate_metrics(evaluator.finalize(metrics))
 
             # Make plots.
             log_dict = {k: metrics[k]["metric"] for k in metrics}
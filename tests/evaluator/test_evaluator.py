@@ -11,8 +11,10 @@ import torch
 
 from ocpmodels.modules.evaluator import (
     Evaluator,
-    cosine_similarity,
-    magnitude_error,
+    average_distance_within_threshold,
+    energy_force_within_threshold,
+    forces_cos,
+    forces_magnitude,
 )
 
 
@@ -66,22 +68,172 @@ def load_evaluator_is2re(request):
     request.cls.metrics = request.cls.evaluator.eval(prediction, target)
 
 
+def per_system_energy_force_within_threshold(prediction, target):
+    # Reference per-system loop the vectorized metric replaced.
+    success, start_idx = 0, 0
+    error_forces = torch.abs(target["forces"] - prediction["forces"])
+    error_energy = torch.abs(target["energy"] - prediction["energy"])
+    for i, n in enumerate(target["natoms"]):
+        if (
+            error_energy[i] < 0.02
+            and error_forces[start_idx : start_idx + n].max() < 0.03
+        ):
+            success += 1
+        start_idx += n
+    return success
+
+
+def numpy_average_distance_within_threshold(prediction, target):
+    # Reference per-system numpy implementation the batched metric replaced.
+    def min_diff(pred_pos, dft_pos, cell, pbc):
+        pos_diff = pred_pos - dft_pos
+        fractional = np.linalg.solve(cell.T, pos_diff.T).T
+        for i, periodic in enumerate(pbc):
+            if periodic:
+                fractional[:, i] %= 1.0
+                fractional[:, i] %= 1.0
+        fractional[fractional > 0.5] -= 1
+        return np.matmul(fractional, cell)
+
+    pred_pos = torch.split(
+        prediction["positions"], prediction["natoms"].tolist()
+    )
+    target_pos = torch.split(target["positions"], target["natoms"].tolist())
+    mean_distance = [
+        np.mean(
+            np.linalg.norm(
+                min_diff(
+                    ml_pos.numpy(),
+                    target_pos[idx].numpy(),
+                    target["cell"][idx].numpy(),
+                    target["pbc"].tolist(),
+                ),
+                axis=1,
+            )
+        )
+        for idx, ml_pos in enumerate(pred_pos)
+    ]
+    success = 0
+    for i in np.arange(0.01, 0.5, 0.001):
+        success += sum(np.array(mean_distance) < i)
+    return success
+
+
 class TestMetrics:
-    def test_cosine_similarity(self):
-        v1, v2 = torch.randn(1000000, 3), torch.randn(1000000, 3)
-        res = cosine_similarity(v1, v2)
-        np.testing.assert_almost_equal(res["metric"], 0, decimal=3)
+    def test_forces_cos(self):
+        prediction = {"forces": torch.randn(1000000, 3)}
+        target = {"forces": torch.randn(1000000, 3)}
+        res = forces_cos(prediction, target)
+        np.testing.assert_almost_equal(res["metric"].item(), 0, decimal=3)
         np.testing.assert_almost_equal(
-            res["total"] / res["numel"], res["metric"]
+            res["total"].item() / res["numel"], res["metric"].item()
         )
 
-    def test_magnitude_error(self):
-        v1, v2 = (
-            torch.tensor([[0.0, 1], [-1, 0]]),
-            torch.tensor([[0.0, 0], [0, 0]]),
+    def test_forces_magnitude(self):
+        prediction = {"forces": torch.tensor([[0.0, 1], [-1, 0]])}
+        target = {"forces": torch.tensor([[0.0, 0], [0, 0]])}
+        res = forces_magnitude(prediction, target)
+        np.testing.assert_equal(res["metric"].item(), 1.0)
+
+    def test_energy_force_within_threshold(self):
+        # Uneven system sizes, with errors spread around both thresholds so
+        # that systems pass and fail on either criterion.
+        generator = torch.Generator().manual_seed(0)
+        natoms = torch.tensor((1, 7, 3, 12, 2, 5, 9, 4, 1, 6))
+        n = int(natoms.sum())
+        target = {
+            "energy": torch.randn(10, generator=generator),
+            "forces": torch.randn(n, 3, generator=generator),
+            "natoms": natoms,
+        }
+        prediction = {
+            "energy": target["energy"]
+            + 0.04 * torch.rand(10, generator=generator)
+            - 0.02,
+            "forces": target["forces"]
+            + 0.035 * torch.rand(n, 3, generator=generator) ** 4
+            - 0.0175 * torch.rand(n, 3, generator=generator) ** 4,
+            "natoms": natoms,
+        }
+        res = energy_force_within_threshold(prediction, target)
+
+        success = per_system_energy_force_within_threshold(prediction, target)
+        assert 0 < success < 10
+        np.testing.assert_equal(int(res["total"]), success)
+        # Same result with the system index passed in, as the trainers do.
+        target["batch_idx"] = torch.repeat_interleave(torch.arange(10), natoms)
+        res = energy_force_within_threshold(prediction, target)
+        np.testing.assert_equal(int(res["total"]), success)
+        np.testing.assert_equal(res["numel"], 10)
+        np.testing.assert_almost_equal(float(res["metric"]), success / 10)
+
+    def test_average_distance_within_threshold(self):
+        generator = torch.Generator().manual_seed(0)
+        natoms = torch.tensor((4, 1, 9, 2, 6, 1, 1, 1, 1))
+        n = int(natoms.sum())
+        batch_idx = torch.repeat_interleave(torch.arange(9), natoms)
+        cell = 4 * torch.eye(3, dtype=torch.float64) + 0.5 * torch.rand(
+            9, 3, 3, generator=generator, dtype=torch.float64
+        )
+        target_pos = 8 * torch.rand(
+            n, 3, generator=generator, dtype=torch.float64
+        )
+        # Small displacements plus whole and half cell shifts, which wrap
+        # along the periodic x and z axes only.
+        shift = torch.randint(-2, 3, (n, 3), generator=generator) / 2
+        pred_pos = (
+            target_pos
+            + 0.3 * torch.randn(n, 3, generator=generator, dtype=torch.float64)
+            + torch.einsum("ni,nij->nj", shift.double(), cell[batch_idx])
+        )
+        # The last four systems hold a single atom, displaced from the origin
+        # along the non-periodic y axis of a cubic cell: by exactly a
+        # threshold, below the first one, by exactly the last one and past
+        # all of them.
+        thresholds = np.arange(0.01, 0.5, 0.001)
+        cell[-4:] = 4 * torch.eye(3, dtype=torch.float64)
+        target_pos[-4:] = 0
+        pred_pos[-4:] = 0
+        pred_pos[-4:, 1] = torch.tensor(
+            (thresholds[137], 0.005, thresholds[-1], 0.6)
         )
-        res = magnitude_error(v1, v2)
-        np.testing.assert_equal(res["metric"], 1.0)
+        prediction = {"positions": pred_pos, "natoms": natoms}
+        target = {
+            "positions": target_pos,
+            "cell": cell,
+            "natoms": natoms,
+            "pbc": torch.tensor([True, False, True]),
+        }
+        res = average_distance_within_threshold(prediction, target)
+
+        success = numpy_average_distance_within_threshold(prediction, target)
+        np.testing.assert_equal(int(res["total"]), success)
+        np.testing.assert_equal(res["numel"], 9 * len(thresholds))
+        target["batch_idx"] = batch_idx
+        res = average_distance_within_threshold(prediction, target)
+        np.testing.assert_equal(int(res["total"]), success)
+
+    def test_update_finalize(self):
+        evaluator, metrics = Evaluator(task="is2re"), {}
+        metrics = evaluator.update("loss", torch.tensor(1.0), metrics)
+        metrics = evaluator.update("loss", torch.tensor(2.0), metrics)
+        metrics = evaluator.update("lr", 0.5, metrics)
+        assert torch.is_tensor(metrics["loss"]["total"])
+
+        res = evaluator.finalize(metrics)
+        np.testing.assert_equal(res["loss"]["total"], 3.0)
+        np.testing.assert_equal(res["loss"]["numel"], 2)
+        np.testing.assert_equal(res["loss"]["metric"], 1.5)
+        np.testing.assert_equal(res["lr"]["metric"], 0.5)
+
+    def test_update_detaches_totals(self):
+        evaluator = Evaluator(task="is2re")
+        prediction = {"energy": torch.randn(10, requires_grad=True)}
+        target = {"energy": torch.randn(10)}
+        metrics = evaluator.eval(prediction, target)
+        metrics = evaluator.eval(prediction, target, prev_metrics=metrics)
+        for stat in metrics.values():
+            assert not stat["total"].requires_grad
 
 
 @pytest.mark.usefixtures("load_evaluator_s2ef")
@@ -0,0 +1,291 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+from types import SimpleNamespace
+
+import ase.io
+import numpy as np
+import pytest
+import torch
+
+from ocpmodels.common.relaxation.optimizers.lbfgs_torch import (
+    LBFGS,
+    _two_loop_recursion,
+)
+
+
+class QuadraticCalc:
+    """
+    Toy calculator mimicking a force model's `predict`: it sets
+    requires_grad on the positions and returns forces from autograd.
+    """
+
+    def __init__(self, center, stiffness=1.0):
+        self.center = center
+        self.stiffness = stiffness
+        self.calls = 0
+        # Largest force norm of each system, per call.
+        self.max_forces = []
+
+    def get_forces(self, atoms, apply_constraint=True):
+        self.calls += 1
+        atoms.pos.requires_grad_(True)
+        per_atom = (self.stiffness * (atoms.pos - self.center) ** 2).sum(dim=1)
+        energy = torch.zeros(atoms.natoms.numel()).index_add(
+            0, atoms.batch, per_atom
+        )
+        forces = -torch.autograd.grad(
+            energy.sum(), atoms.pos, create_graph=True
+        )[0]
+        if apply_constraint:
+            forces = torch.where(
+                atoms.fixed.unsqueeze(1) == 1,
+                torch.zeros_like(forces),
+                forces,
+            )
+        self.max_forces.append(
+            [
+                forces[atoms.batch == i].norm(dim=1).max().item()
+                for i in range(atoms.natoms.numel())
+            ]
+        )
+        return energy, forces
+
+    def update_graph(self, atoms):
+        return atoms
+
+
+def make_batch(natoms, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    natoms = torch.tensor(natoms)
+    n = int(natoms.sum())
+    return SimpleNamespace(
+        pos=torch.randn(n, 3, generator=generator),
+        natoms=natoms,
+        batch=torch.repeat_interleave(torch.arange(natoms.numel()), natoms),
+        fixed=torch.zeros(n, dtype=torch.bool),
+        # Only needed to convert the batch to ase.Atoms for trajectories.
+        neighbors=torch.zeros(natoms.numel(), dtype=torch.long),
+        atomic_numbers=torch.full((n,), 29, dtype=torch.long),
+        tags=torch.ones(n, dtype=torch.long),
+        cell=10 * torch.eye(3).repeat(natoms.numel(), 1, 1),
+    )
+
+
+def reference_two_loop(q, s, y, H0):
+    # Textbook per-entry two-loop recursion over the (oldest to newest)
+    # history pairs.
+    rho = [1.0 / torch.dot(y_i, s_i) for s_i, y_i in zip(s, y)]
+    alpha = [None] * len(s)
+    q = q.clone()
+    for i in reversed(range(len(s))):
+        alpha[i] = rho[i] * torch.dot(s[i], q)
+        q -= alpha[i] * y[i]
+    z = H0 * q
+    for i in range(len(s)):
+        beta = rho[i] * torch.dot(y[i], z)
+        z += s[i] * (alpha[i] - beta)
+    return z
+
+
+class TestLBFGS:
+    @pytest.mark.parametrize("iterations", [0, 3, 7, 11, 18])
+    def test_two_loop_recursion(self, iterations):
+        # Fill a ring buffer of 7 entries the way LBFGS.step does, wrapping
+        # around once the number of iterations exceeds the memory.
+        memory, n = 7, 30
+        generator = torch.Generator().manual_seed(iterations)
+        A = torch.randn(n, n, generator=generator, dtype=torch.float64)
+        A = A @ A.t() / n + torch.eye(n, dtype=torch.float64)
+        s = torch.zeros(memory, n, dtype=torch.float64)
+        y = torch.zeros(memory, n, dtype=torch.float64)
+        sy = torch.zeros(memory, memory, dtype=torch.float64)
+        history = []
+        for iteration in range(1, iterations + 1):
+            count = min(memory, iteration)
+            head = (iteration - 1) % memory
+            s[head] = torch.randn(n, generator=generator, dtype=torch.float64)
+            y[head] = A @ s[head]
+            sy[head, :count] = torch.mv(y[:count], s[head])
+            sy[:count, head] = torch.mv(s[:count], y[head])
+            history = (history + [(s[head].clone(), y[head].clone())])[
+                -memory:
+            ]
+        count = min(memory, iterations)
+        start = (iterations - count) % memory
+
+        q = torch.randn(n, generator=generator, dtype=torch.float64)
+        H0 = torch.tensor(1.0 / 70.0, dtype=torch.float64)
+        expected = reference_two_loop(
+            q, [p[0] for p in history], [p[1] for p in history], H0
+        )
+        # q is overwritten as a work buffer, and z receives the result.
+        z = torch.empty_like(q)
+        out = _two_loop_recursion(q.clone(), z, s, y, sy, start, count, H0)
+        assert out.data_ptr() == z.data_ptr()
+        np.testing.assert_allclose(z.numpy(), expected.numpy(), rtol=1e-10)
+
+    def test_relax_with_grad_requiring_positions(self):
+        batch = make_batch([3, 5, 4])
+        calc = QuadraticCalc(center=torch.zeros(12, 3))
+        optimizer = LBFGS(
+            batch,
+            calc,
+            maxstep=0.04,
+            memory=10,
+            damping=1.0,
+            alpha=70.0,
+            device="cpu",
+        )
+        relaxed = optimizer.run(fmax=0.05, steps=300)
+
+        # Converged before running out of steps, close to the minimum.
+        assert calc.calls < 300
+        assert relaxed.pos.norm(dim=1).max() < 0.1
+        # Each step restarts from leaf positions instead of extending the
+        # graph the calculator built on the previous ones.
+        assert relaxed.pos.grad_fn is None
+
+    def test_relax_with_scale_H0(self):
+        # An anisotropic well, so that the scaled H0 is not the exact inverse
+        # Hessian.
+        batch = make_batch([3, 5, 4])
+        calc = QuadraticCalc(
+            center=torch.zeros(12, 3), stiffness=torch.tensor([0.5, 1, 2])
+        )
+        optimizer = LBFGS(
+            batch,
+            calc,
+            maxstep=0.04,
+            memory=10,
+            damping=1.0,
+            alpha=70.0,
+            device="cpu",
+            scale_H0=True,
+        )
+        relaxed = optimizer.run(fmax=0.05, steps=300)
+
+        assert calc.calls < 300
+        assert relaxed.pos.norm(dim=1).max() < 0.1
+
+    @pytest.mark.parametrize("curvature", [-2.0, 2.0])
+    def test_scale_H0_step(self, curvature):
+        # Take the second step of a relaxation from a crafted previous step
+        # whose force change is y = -curvature * s, with and without
+        # scaling H0. The maxstep is large enough that steps are not
+        # clipped.
+        positions = []
+        for scale_H0 in (False, True):
+            batch = make_batch([3, 5, 4])
+            optimizer = LBFGS(
+                batch,
+                QuadraticCalc(center=torch.zeros(12, 3)),
+                maxstep=10.0,
+                memory=5,
+                damping=1.0,
+                alpha=70.0,
+                device="cpu",
+                scale_H0=scale_H0,
+            )
+            r = batch.pos.clone()
+            f = -2 * r
+            d = 0.1 * make_batch([3, 5, 4], seed=1).pos
+            s = torch.zeros(5, r.numel())
+            y = torch.zeros_like(s)
+            sy = torch.zeros(5, 5, dtype=torch.float64)
+            q, z = torch.empty(r.numel()), torch.empty(r.numel())
+            H0 = torch.tensor(1.0 / 70.0)
+            update_mask = torch.ones(12, dtype=torch.bool)
+            optimizer.step(
+                1, r - d, f + curvature * d, H0, s, y, sy, q, z, update_mask
+            )
+            positions.append(batch.pos)
+
+        if curvature < 0:
+            # s . y <= 0 breaks the curvature condition: keep 1 / alpha.
+            np.testing.assert_allclose(
+                positions[0].numpy(), positions[1].numpy()
+            )
+        else:
+            assert not torch.allclose(positions[0], positions[1])
+
+    @pytest.mark.parametrize("steps", [5, 300])
+    def test_log_every_logs_last_iteration(self, steps, caplog):
+        batch = make_batch([3, 5, 4])
+        calc = QuadraticCalc(center=torch.zeros(12, 3))
+        optimizer = LBFGS(
+            batch,
+            calc,
+            maxstep=0.04,
+            memory=10,
+            damping=1.0,
+            alpha=70.0,
+            device="cpu",
+            log_every=1000,
+        )
+        with caplog.at_level("INFO"):
+            optimizer.run(fmax=0.05, steps=steps)
+
+        # Whether the relaxation stops by running out of steps (5) or by
+        # converging (300), its final forces are logged even though
+        # log_every is never reached. The last force evaluation is the one
+        # after the loop.
+        iterations = calc.calls - 1
+        messages = [r.getMessage() for r in caplog.records]
+        assert len(messages) == 1
+        assert messages[0].split()[0] == str(iterations)
+
+    def test_trajectories(self, tmp_path):
+        batch = make_batch([3, 5, 4])
+        calc = QuadraticCalc(center=torch.zeros(12, 3))
+        names = ["a", "b", "c"]
+        optimizer = LBFGS(
+            batch,
+            calc,
+            maxstep=0.04,
+            memory=10,
+            damping=1.0,
+            alpha=70.0,
+            device="cpu",
+            traj_dir=tmp_path,
+            traj_names=names,
+        )
+        optimizer.run(fmax=0.05, steps=300)
+
+        # A frame is written for every step a system is still active, up to
+        # and including the one whose forces are below fmax. The last force
+        # evaluation, after the loop, writes nothing.
+        max_forces = np.array(calc.max_forces[:-1])
+        below = max_forces < 0.05
+        expected = np.where(
+            below.any(axis=0), below.argmax(axis=0) + 1, len(max_forces)
+        )
+        assert len(set(expected)) > 1
+        for name, n_frames in zip(names, expected):
+            frames = ase.io.read(tmp_path / f"{name}.traj", index=":")
+            assert len(frames) == n_frames
+
+    def test_trajectory_write_error(self, tmp_path, monkeypatch):
+        def fail(self, atoms=None, **kwargs):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(ase.io.trajectory.TrajectoryWriter, "write", fail)
+        batch = make_batch([3, 5, 4])
+        optimizer = LBFGS(
+            batch,
+            QuadraticCalc(center=torch.zeros(12, 3)),
+            maxstep=0.04,
+            memory=10,
+            damping=1.0,
+            alpha=70.0,
+            device="cpu",
+            traj_dir=tmp_path,
+            traj_names=["a", "b", "c"],
+        )
+        # The writer thread's error surfaces from run.
+        with pytest.raises(OSError, match="disk full"):
+            optimizer.run(fmax=0.05, steps=300)